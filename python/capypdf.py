@@ -13,6 +13,7 @@
 # limitations under the License.
 
 
+import array
 import ctypes
 import os
 import math
@@ -94,6 +95,9 @@ class IccColorSpaceId(ctypes.Structure):
 class OptionalContentGroupId(ctypes.Structure):
     _fields_ = [('id', ctypes.c_int32)]
 
+class Glyph(ctypes.Structure):
+    _fields_ = [('codepoint', ctypes.c_uint32), ('x', ctypes.c_double), ('y', ctypes.c_double)]
+
 
 cfunc_types = (
 
@@ -116,6 +120,7 @@ cfunc_types = (
 ('capy_generator_add_optional_content_group', [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]),
 ('capy_generator_destroy', [ctypes.c_void_p]),
 ('capy_generator_text_width', [ctypes.c_void_p, ctypes.c_char_p, FontId, ctypes.c_double, ctypes.POINTER(ctypes.c_double)]),
+('capy_generator_text_widths', [ctypes.c_void_p, ctypes.POINTER(ctypes.c_char_p), ctypes.c_int32, FontId, ctypes.c_double, ctypes.POINTER(ctypes.c_double)]),
 
 ('capy_page_draw_context_new', [ctypes.c_void_p, ctypes.c_void_p]),
 ('capy_dc_add_simple_navigation', [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int32, ctypes.c_void_p]),
@@ -163,6 +168,8 @@ cfunc_types = (
     [ctypes.c_void_p, ctypes.c_char_p, FontId, ctypes.c_double, ctypes.c_double, ctypes.c_double]),
 ('capy_dc_render_text_obj',
     [ctypes.c_void_p, ctypes.c_void_p]),
+('capy_dc_render_glyphs',
+    [ctypes.c_void_p, FontId, ctypes.c_double, ctypes.POINTER(Glyph), ctypes.c_int32]),
 ('capy_dc_set_nonstroke', [ctypes.c_void_p, ctypes.c_void_p]),
 ('capy_dc_text_new', [ctypes.c_void_p, ctypes.c_void_p]),
 ('capy_dc_destroy', [ctypes.c_void_p]),
@@ -439,6 +446,13 @@ class DrawContext:
     def render_text_obj(self, tobj):
         check_error(libfile.capy_dc_render_text_obj(self, tobj))
 
+    def render_glyphs(self, glyphs, fid, point_size):
+        if not isinstance(fid, FontId):
+            raise CapyPDFException('Font id argument is not a font id object.')
+        if not isinstance(glyphs, ctypes.Array):
+            glyphs = (len(glyphs)*Glyph)(*glyphs)
+        check_error(libfile.capy_dc_render_glyphs(self, fid, point_size, glyphs, len(glyphs)))
+
     def draw_image(self, iid):
         if not isinstance(iid, ImageId):
             raise CapyPDFException('Image id argument is not an image id object.')
@@ -544,6 +558,22 @@ class Generator:
         check_error(libfile.capy_generator_text_width(self, bytes, font, pointsize, ctypes.pointer(w)))
         return w.value
 
+    def text_widths(self, texts, font, pointsize):
+        if not all(isinstance(text, str) for text in texts):
+            raise CapyPDFException('Texts must be Unicode strings.')
+        if not isinstance(font, FontId):
+            raise CapyPDFException('Argument not a font object.')
+        num_texts = len(texts)
+        text_array = (ctypes.c_char_p * num_texts)(*[text.encode('UTF-8') for text in texts])
+        widths = array.array('d', [0.0]) * num_texts
+        check_error(libfile.capy_generator_text_widths(self,
+                                                        text_array,
+                                                        num_texts,
+                                                        font,
+                                                        pointsize,
+                                                        (ctypes.c_double * num_texts).from_buffer(widths)))
+        return widths
+
     def add_optional_content_group(self, ocg):
         ocgid = OptionalContentGroupId()
         check_error(libfile.capy_generator_add_optional_content_group(self, ocg, ctypes.pointer(ocgid)))
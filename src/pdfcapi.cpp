@@ -230,6 +230,30 @@ CAPYPDF_PUBLIC CAPYPDF_EC capy_generator_text_width(CapyPDF_Generator *generator
     return conv_err(rc);
 }
 
+CAPYPDF_PUBLIC CAPYPDF_EC capy_generator_text_widths(CapyPDF_Generator *generator,
+                                                     const char **utf8_texts,
+                                                     int32_t num_texts,
+                                                     CapyPDF_FontId font,
+                                                     double pointsize,
+                                                     double *widths) CAPYPDF_NOEXCEPT {
+    auto *g = reinterpret_cast<PdfGen *>(generator);
+    if(num_texts < 0) {
+        return conv_err(ErrorCode::IndexIsNegative);
+    }
+    for(int32_t i = 0; i < num_texts; ++i) {
+        auto u8t = u8string::from_cstr(utf8_texts[i]);
+        if(!u8t) {
+            return conv_err(u8t);
+        }
+        auto rc = g->utf8_text_width(u8t.value(), font, pointsize);
+        if(!rc) {
+            return conv_err(rc);
+        }
+        widths[i] = rc.value();
+    }
+    RETNOERR;
+}
+
 // Draw Context
 
 CAPYPDF_EC capy_page_draw_context_new(CapyPDF_Generator *g,
@@ -485,6 +509,23 @@ CAPYPDF_PUBLIC CAPYPDF_EC capy_dc_render_text_obj(CapyPDF_DrawContext *ctx,
     return conv_err(c->render_text(*t));
 }
 
+CAPYPDF_PUBLIC CAPYPDF_EC capy_dc_render_glyphs(CapyPDF_DrawContext *ctx,
+                                                CapyPDF_FontId fid,
+                                                double point_size,
+                                                const CapyPDF_Glyph *glyphs,
+                                                int32_t num_glyphs) CAPYPDF_NOEXCEPT {
+    auto c = reinterpret_cast<PdfDrawContext *>(ctx);
+    if(num_glyphs < 0) {
+        return conv_err(ErrorCode::IndexIsNegative);
+    }
+    std::vector<PdfGlyph> pdfglyphs;
+    pdfglyphs.reserve(num_glyphs);
+    for(int32_t i = 0; i < num_glyphs; ++i) {
+        pdfglyphs.emplace_back(PdfGlyph{glyphs[i].codepoint, glyphs[i].x, glyphs[i].y});
+    }
+    return conv_err(c->render_glyphs(pdfglyphs, fid, point_size));
+}
+
 CAPYPDF_PUBLIC CAPYPDF_EC capy_dc_set_page_transition(
     CapyPDF_DrawContext *dc, CapyPDF_Transition *transition) CAPYPDF_NOEXCEPT {
     auto ctx = reinterpret_cast<PdfDrawContext *>(dc);
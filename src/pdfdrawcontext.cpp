@@ -990,26 +990,24 @@ ErrorCode PdfDrawContext::render_glyphs(const std::vector<PdfGlyph> &glyphs,
         return ErrorCode::NoError;
     }
     auto &font_data = doc->font_objects.at(fid.id);
-    // FIXME, do per character.
-    // const auto &bob =
-    //    doc->font_objects.at(doc->get_subset_glyph(fid, glyphs.front().codepoint).ss.fid.id);
-    fmt::format_to(cmd_appender,
-                   R"({}BT
-{}  /SFont{}-{} {:f} Tf
-)",
-                   ind,
-                   ind,
-                   font_data.font_obj,
-                   0,
-                   pointsize);
+    int32_t current_subset{-1};
+    fmt::format_to(cmd_appender, "{}BT\n", ind);
     for(const auto &g : glyphs) {
         auto rv = doc->get_subset_glyph(fid, g.codepoint);
         if(!rv) {
             return rv.error();
         }
         auto &current_subset_glyph = rv.value();
-        // const auto &bob = doc->font_objects.at(current_subset_glyph.ss.fid.id);
         used_subset_fonts.insert(current_subset_glyph.ss);
+        if(current_subset_glyph.ss.subset_id != current_subset) {
+            current_subset = current_subset_glyph.ss.subset_id;
+            fmt::format_to(cmd_appender,
+                           "{}  /SFont{}-{} {:f} Tf\n",
+                           ind,
+                           font_data.font_obj,
+                           current_subset,
+                           pointsize);
+        }
         fmt::format_to(cmd_appender, "  {:f} {:f} Td\n", g.x - prev_x, g.y - prev_y);
         prev_x = g.x;
         prev_y = g.y;
@@ -16,24 +16,180 @@
 
 
 import unittest
-import os, sys, pathlib, shutil, subprocess
-import PIL.Image, PIL.ImageChops
+import os, sys, io, pathlib, shutil, subprocess, functools, atexit
+import queue, threading, time
+import PIL.Image
+import numpy as np
 
 if shutil.which('gs') is None:
     sys.exit('Ghostscript not found, test suite can not be run.')
 
+# This is done at import time rather than in fixtures, because
+# unittest-parallel does not run module or class fixtures with --level=test.
+# Its worker processes import this module, so they get the same setup.
+# The source root comes from the environment as worker processes do not get argv.
 os.environ['CAPYPDF_SO_OVERRIDE'] = 'src' # Sucks, but there does not seem to be a better injection point.
-source_root = pathlib.Path(sys.argv[1])
+source_root = pathlib.Path(os.environ.get('CAPYPDF_SOURCE_ROOT', pathlib.Path(__file__).parent / '..'))
 testdata_dir = source_root / 'testoutput'
 image_dir = source_root / 'images'
 sys.path.append(str(source_root / 'python'))
 
 noto_fontdir = pathlib.Path('/usr/share/fonts/truetype/noto')
 
-sys.argv = sys.argv[0:1] + sys.argv[2:]
-
 import capypdf
 
+def scoped_name(basename, suffix):
+    # Parallel workers share a working directory, so output files must not collide.
+    return pathlib.Path(f'{basename}.{os.getpid()}{suffix}')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Printed by the EndPage procedure for every page that is output.
+GS_PAGE_MARKER = b'CAPYPDF_PAGE\n'
+# Printed after each file has been processed.
+GS_DONE_MARKER = b'CAPYPDF_DONE\n'
+
+GS_PAGE_SETUP = '/EndPage { exch pop 2 ne dup { (CAPYPDF_PAGE\\n) print flush } if }'
+
+class GhostscriptError(Exception):
+    pass
+
+class GhostscriptServer:
+    # A single interpreter that renders all test files so that Ghostscript's
+    # startup and font cache initialisation is only paid once. Rendered pages
+    # are written to stdout as PNG. PostScript output, including the page and
+    # end of job markers, goes to stderr.
+    timeout = 60
+
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        self.proc = subprocess.Popen(['gs',
+                                      '-q',
+                                      '-dNOPAUSE',
+                                      '-dBATCH',
+                                      # Keep SAFER mode, the only files gs needs are the test PDFs.
+                                      f'--permit-file-read={pathlib.Path.cwd().resolve()}/',
+                                      '-dFIXEDMEDIA',
+                                      '-r72',
+                                      '-sDEVICE=png16m',
+                                      '-sOutputFile=-',
+                                      '-sstdout=%stderr',
+                                      '-'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        # Both pipes are drained in threads so that reads can time out and
+        # gs never blocks on a full pipe.
+        self.data = queue.Queue()
+        self.messages = queue.Queue()
+        self.buf = b''
+        threading.Thread(target=self.pump,
+                         args=(functools.partial(self.proc.stdout.read1, 65536), self.data),
+                         daemon=True).start()
+        threading.Thread(target=self.pump,
+                         args=(self.proc.stderr.readline, self.messages),
+                         daemon=True).start()
+
+    @staticmethod
+    def pump(read, q):
+        while True:
+            chunk = read()
+            q.put(chunk)
+            if not chunk:
+                return
+
+    def restart(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.start()
+
+    def submit(self, pdfname, w, h):
+        # Returns immediately, the result is fetched with read_png. The only
+        # work validate_image does in between is reading the oracle PNG file.
+        # File permissions are checked against the full path.
+        ps_name = str(pathlib.Path(pdfname).resolve())
+        ps_name = ps_name.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        cmd = f'<< /PageSize [{w} {h}] {GS_PAGE_SETUP} >> setpagedevice\n'
+        cmd += f'{{ ({ps_name}) run }} stopped {{ clear quit }} if\n'
+        cmd += '(CAPYPDF_DONE\\n) print flush\n'
+        self.proc.stdin.write(cmd.encode('UTF-8'))
+        self.proc.stdin.flush()
+
+    def read_png(self):
+        deadline = time.monotonic() + self.timeout
+        try:
+            num_pages = self.wait_for_job(deadline)
+            pages = [self.read_one_png(deadline) for _ in range(num_pages)]
+        except queue.Empty:
+            self.restart()
+            raise GhostscriptError(f'Ghostscript did not finish in {self.timeout} seconds.')
+        except GhostscriptError:
+            self.restart()
+            raise
+        if num_pages != 1:
+            raise GhostscriptError(f'Expected one page, got {num_pages}.')
+        return pages[0]
+
+    def wait_for_job(self, deadline):
+        num_pages = 0
+        output = []
+        while True:
+            line = self.messages.get(timeout=max(deadline - time.monotonic(), 0))
+            if not line:
+                msg = b''.join(output).decode('UTF-8', errors='replace')
+                raise GhostscriptError(f'Ghostscript exited unexpectedly.\n{msg}')
+            if line == GS_DONE_MARKER:
+                return num_pages
+            if line == GS_PAGE_MARKER:
+                num_pages += 1
+            else:
+                output.append(line)
+
+    def read_bytes(self, num_bytes, deadline):
+        while len(self.buf) < num_bytes:
+            chunk = self.data.get(timeout=max(deadline - time.monotonic(), 0))
+            if not chunk:
+                raise GhostscriptError('Ghostscript exited unexpectedly.')
+            self.buf += chunk
+        result, self.buf = self.buf[:num_bytes], self.buf[num_bytes:]
+        return result
+
+    def read_one_png(self, deadline):
+        # The data stream has no other framing, so read the PNG chunk by chunk up to IEND.
+        signature = self.read_bytes(len(PNG_SIGNATURE), deadline)
+        if signature != PNG_SIGNATURE:
+            raise GhostscriptError('Ghostscript output is not a PNG file.')
+        parts = [signature]
+        while True:
+            header = self.read_bytes(8, deadline)
+            length = int.from_bytes(header[:4], 'big')
+            parts += [header, self.read_bytes(length + 4, deadline)]
+            if header[4:] == b'IEND':
+                return b''.join(parts)
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.write(b'quit\n')
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+gs_server = None
+
+def get_gs():
+    # One server per process. Created lazily because under unittest-parallel
+    # every worker is its own process and class fixtures are not run.
+    global gs_server
+    if gs_server is None:
+        gs_server = GhostscriptServer()
+        atexit.register(gs_server.close)
+    return gs_server
+
 def draw_intersect_shape(ctx):
     ctx.cmd_m(50, 90)
     ctx.cmd_l(80, 10)
@@ -42,51 +198,70 @@ def draw_intersect_shape(ctx):
     ctx.cmd_l(20, 10)
     ctx.cmd_h()
 
+def _ensure_oracle_npy(basename):
+    # Decoding the oracle PNG on every run is wasted work, so keep a decoded
+    # copy in the build directory. The PNG stays in the source tree for review.
+    png = testdata_dir / (basename + '.png')
+    npy = pathlib.Path(basename + '.npy')
+    if not npy.exists() or npy.stat().st_mtime < png.stat().st_mtime:
+        np.save(npy, np.asarray(PIL.Image.open(png).convert('RGB')))
+    return npy
+
+def diff_bbox(a, b):
+    # Same as PIL's getbbox() on the difference image: (x0, y0, x1, y1) exclusive.
+    mismatch = np.any(a != b, axis=-1)
+    rows = np.any(mismatch, axis=1)
+    cols = np.any(mismatch, axis=0)
+    y0, y1 = np.argmax(rows), len(rows) - np.argmax(rows[::-1])
+    x0, x1 = np.argmax(cols), len(cols) - np.argmax(cols[::-1])
+    return (int(x0), int(y0), int(x1), int(y1))
+
+def render_pdf(pdfname, w, h):
+    gs = get_gs()
+    gs.submit(pdfname, w, h)
+    return np.asarray(PIL.Image.open(io.BytesIO(gs.read_png())).convert('RGB'))
+
 def validate_image(basename, w, h):
-    import functools
     def decorator_validate(func):
         @functools.wraps(func)
         def wrapper_validate(*args, **kwargs):
-            assert(len(args) == 1)
             utobj = args[0]
-            pngname = pathlib.Path(basename + '.png')
-            pdfname = pathlib.Path(basename + '.pdf')
+            pdfname = scoped_name(basename, '.pdf')
             args = (args[0], pdfname, w, h)
             try:
-                pdfname.unlink()
-            except Exception:
-                pass
-            utobj.assertFalse(os.path.exists(pdfname), 'PDF file already exists.')
-            value = func(*args, **kwargs)
-            the_truth = testdata_dir / pngname
-            utobj.assertTrue(os.path.exists(pdfname), 'Test did not generate a PDF file.')
-            utobj.assertEqual(subprocess.run(['gs',
-                                              '-q',
-                                              '-dNOPAUSE',
-                                              '-dBATCH',
-                                              '-sDEVICE=png16m',
-                                              f'-g{w}x{h}',
-                                              #'-dPDFFitPage',
-                                              f'-sOutputFile={pngname}',
-                                              str(pdfname)]).returncode, 0)
-            oracle_image = PIL.Image.open(the_truth)
-            gen_image = PIL.Image.open(pngname)
-            diff = PIL.ImageChops.difference(oracle_image, gen_image)
-            utobj.assertFalse(diff.getbbox(), 'Rendered image is different.')
-            pdfname.unlink()
-            pngname.unlink()
+                value = func(*args, **kwargs)
+                utobj.assertTrue(pdfname.exists(), 'Test did not generate a PDF file.')
+                gs = get_gs()
+                gs.submit(pdfname, w, h)
+                oracle_png = (testdata_dir / (basename + '.png')).read_bytes()
+                try:
+                    png_data = gs.read_png()
+                except GhostscriptError as e:
+                    utobj.fail(f'Ghostscript could not render the PDF: {e}')
+                if png_data != oracle_png:
+                    # The PNG encoding may change even if the pixels do not.
+                    oracle = np.load(_ensure_oracle_npy(basename), mmap_mode='r')
+                    gen = np.asarray(PIL.Image.open(io.BytesIO(png_data)).convert('RGB'))
+                    utobj.assertEqual(oracle.shape, gen.shape, 'Rendered image has wrong size.')
+                    if not np.array_equal(oracle, gen):
+                        # Only compute the bounding box when there is something to report.
+                        utobj.fail(f'Rendered image is different, bbox {diff_bbox(oracle, gen)}.')
+            finally:
+                pdfname.unlink(missing_ok=True)
             return value
         return wrapper_validate
     return decorator_validate
 
-def cleanup(ofilename):
-    import functools
+def cleanup(basename):
     def decorator_validate(func):
         @functools.wraps(func)
         def wrapper_validate(*args, **kwargs):
+            ofilename = scoped_name(basename, '.pdf')
             args = tuple([args[0], ofilename] + list(args)[1:])
-            value = func(*args, **kwargs)
-            os.unlink(ofilename)
+            try:
+                value = func(*args, **kwargs)
+            finally:
+                ofilename.unlink(missing_ok=True)
             return value
         return wrapper_validate
     return decorator_validate
@@ -113,9 +288,8 @@ class TestPDFCreation(unittest.TestCase):
                 ctx.render_text('Av, Tv, kerning yo.', fid, 12, 50, 150)
 
     def test_error(self):
-        ofile = pathlib.Path('delme.pdf')
-        if ofile.exists():
-            ofile.unlink()
+        ofile = scoped_name('delme', '.pdf')
+        self.addCleanup(ofile.unlink, missing_ok=True)
         with self.assertRaises(capypdf.CapyPDFException) as cm_outer:
             with capypdf.Generator(ofile) as g:
                 ctx = g.page_draw_context()
@@ -126,13 +300,25 @@ class TestPDFCreation(unittest.TestCase):
         self.assertEqual(str(cm_outer.exception), 'No pages defined.')
         self.assertFalse(ofile.exists())
 
+    def test_text_widths(self):
+        ofile = scoped_name('widths', '.pdf')
+        self.addCleanup(ofile.unlink, missing_ok=True)
+        g = capypdf.Generator(ofile)
+        fid = g.load_font(noto_fontdir / 'NotoSans-Regular.ttf')
+        words = ['Av,', 'Tv,', 'kerning', 'yo.', '']
+        self.assertEqual(list(g.text_widths(words, fid, 12)),
+                         [g.text_width(w, fid, 12) for w in words])
+        self.assertEqual(list(g.text_widths([], fid, 12)), [])
+        g = None # Destroy without writing, so there should be no output.
+        self.assertFalse(ofile.exists())
+
     def test_line_drawing(self):
-        ofile = pathlib.Path('nope.pdf')
+        ofile = scoped_name('nope', '.pdf')
+        self.addCleanup(ofile.unlink, missing_ok=True)
         with capypdf.Generator(ofile) as g:
             with g.page_draw_context() as ctx:
                 ctx.cmd_J(capypdf.LineCapStyle.Round)
                 ctx.cmd_j(capypdf.LineJoinStyle.Bevel)
-        ofile.unlink()
 
     @validate_image('python_image', 200, 200)
     def test_images(self, ofilename, w, h):
@@ -231,7 +417,35 @@ class TestPDFCreation(unittest.TestCase):
                 ctx.cmd_re(10, 10, 80, 80)
                 ctx.cmd_B()
 
-    @cleanup('transitions.pdf')
+    def test_glyphs(self):
+        # More glyphs than fit in one font subset. The expected image has
+        # the same glyphs drawn one by one with render_text.
+        w = 400
+        h = 400
+        codepoints = list(range(0x21, 0x7f)) + list(range(0xa1, 0x180))
+        positions = [(10 + 19*(i % 20), 380 - 22*(i // 20)) for i in range(len(codepoints))]
+        opts = capypdf.Options()
+        opts.set_pagebox(capypdf.PageBox.Media, 0, 0, w, h)
+        glyphfile = scoped_name('glyphs', '.pdf')
+        self.addCleanup(glyphfile.unlink, missing_ok=True)
+        with capypdf.Generator(glyphfile, opts) as g:
+            fid = g.load_font(noto_fontdir / 'NotoSans-Regular.ttf')
+            with g.page_draw_context() as ctx:
+                ctx.render_glyphs([capypdf.Glyph(cp, x, y) for cp, (x, y) in zip(codepoints, positions)], fid, 12)
+        textfile = scoped_name('glyphs_text', '.pdf')
+        self.addCleanup(textfile.unlink, missing_ok=True)
+        with capypdf.Generator(textfile, opts) as g:
+            fid = g.load_font(noto_fontdir / 'NotoSans-Regular.ttf')
+            with g.page_draw_context() as ctx:
+                for cp, (x, y) in zip(codepoints, positions):
+                    ctx.render_text(chr(cp), fid, 12, x, y)
+        glyph_image = render_pdf(glyphfile, w, h)
+        text_image = render_pdf(textfile, w, h)
+        self.assertEqual(glyph_image.shape, text_image.shape, 'Rendered glyphs have wrong size.')
+        if not np.array_equal(glyph_image, text_image):
+            self.fail(f'Rendered glyphs are different, bbox {diff_bbox(text_image, glyph_image)}.')
+
+    @cleanup('transitions')
     def test_transitions(self, ofilename):
         opts = capypdf.Options()
         opts.set_pagebox(capypdf.PageBox.Media, 0, 0, 160, 90)
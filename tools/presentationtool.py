@@ -14,7 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pathlib, os, sys
+import pathlib, os, sys, array, bisect, functools, itertools
+import concurrent.futures
 
 os.environ['CAPYPDF_SO_OVERRIDE'] = 'src'
 source_root = pathlib.Path(__file__).parent / '..'
@@ -74,6 +75,11 @@ class Demopresentation:
         self.textsize = 32
         self.codesize = 20
         self.symbolsize = 28
+        self.box_indent = 90
+        self.head_dy = 1.5*self.headingsize
+        self.bullet_linesep = 1.2*self.textsize
+        self.bullet_advance = (1.2 - 1.5)*self.textsize
+        self.body_width = self.w - 2*self.box_indent
         opts = capypdf.Options()
         opts.set_author('CapyPDF tester')
         opts.set_pagebox(capypdf.PageBox.Media, 0, 0, w, h)
@@ -82,26 +88,33 @@ class Demopresentation:
         self.boldbasefont = self.pdfgen.load_font(self.boldfontfile)
         self.symbolfont = self.pdfgen.load_font(self.symbolfontfile)
         self.codefont = self.pdfgen.load_font(self.codefontfile)
+        # The bullet marker is drawn as a glyph, which skips text conversion.
+        self.bullet_codepoint = ord('🞂')
+        # Font ids can not be hashed so the cache is keyed on their numeric ids.
+        self.fid_table = {f.id: f for f in (self.basefont, self.boldbasefont, self.symbolfont, self.codefont)}
+        self.cached_text_width = functools.lru_cache(maxsize=4096)(
+            lambda text, fid_id, ptsize: self.pdfgen.text_width(text, self.fid_table[fid_id], ptsize))
+
+    def text_width(self, text, fid, ptsize):
+        return self.cached_text_width(text, fid.id, ptsize)
 
     def split_to_lines(self, text, fid, ptsize, width):
-        if self.pdfgen.text_width(text, fid, ptsize) <= width:
+        if self.text_width(text, fid, ptsize) <= width:
             return [text]
-        words = text.strip().split(' ')
+        words = text.split()
+        widths = self.pdfgen.text_widths(words, fid, ptsize)
+        space_width = self.text_width(' ', fid, ptsize)
+        # offsets[i] is the width of the first i words, each followed by a space.
+        offsets = array.array('d', [0.0])
+        offsets.extend(itertools.accumulate(w + space_width for w in widths))
         lines = []
-        space_width = self.pdfgen.text_width(' ', fid, ptsize)
-        current_line = []
-        current_width = 0
-        for word in words:
-            wwidth = self.pdfgen.text_width(word, fid, ptsize)
-            if current_width + space_width + wwidth >= width:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-                current_width = wwidth
-            else:
-                current_line.append(word)
-                current_width += space_width + wwidth
-        if current_line:
-            lines.append(' '.join(current_line))
+        i = 0
+        while i < len(words):
+            # Words i..j-1 fit if they and the spaces between them are narrower than width.
+            j = bisect.bisect_left(offsets, offsets[i] + width + space_width) - 1
+            j = max(j, i + 1)
+            lines.append(' '.join(words[i:j]))
+            i = j
         return lines
 
     def draw_master(self, ctx):
@@ -113,7 +126,7 @@ class Demopresentation:
             ctx.render_text('https://github.com/jpakkane/capypdf', self.codefont, 12, self.w-280, 10)
 
     def render_centered(self, ctx, text, font, pointsize, x, y):
-        text_w = self.pdfgen.text_width(text, font, pointsize)
+        text_w = self.text_width(text, font, pointsize)
         ctx.render_text(text, font, pointsize, x -text_w/2, y)
 
     def render_title_page(self, ctx, p):
@@ -146,30 +159,68 @@ class Demopresentation:
                              0.35*self.h)
 
 
-    def render_bullet_page(self, ctx, p):
+    def layout_bullet_page(self, p):
+        # Returns the page contents as a list of commands so that the layout
+        # can be computed in a worker process. Fonts are referred to by their
+        # attribute names as font ids are not shared between processes.
+        text_w = self.text_width(p.heading, self.boldbasefont, self.headingsize)
+        head_y = self.h - self.head_dy
+        commands = [('BT',),
+                    ('Tf', 'boldbasefont', self.headingsize),
+                    ('Td', (self.w-text_w)/2, head_y),
+                    ('text', p.heading),
+                    ('ET',)]
+        current_y = head_y - self.head_dy
+        bullet_id = 1
+        for entry in p.entries:
+            # Text objects can not contain optional content markers, so
+            # each bullet gets its own.
+            commands.append(('begin_bullet', 'bullet' + str(bullet_id)))
+            commands += [('glyph', 'symbolfont', self.symbolsize, self.bullet_codepoint, self.box_indent - 40, current_y+1),
+                         ('BT',),
+                         ('Tf', 'basefont', self.textsize),
+                         ('Td', self.box_indent, current_y)]
+            lines = self.split_to_lines(entry, self.basefont, self.textsize, self.body_width)
+            for i, line in enumerate(lines):
+                if i > 0:
+                    commands.append(('Td', 0, -self.bullet_linesep))
+                commands.append(('text', line))
+                current_y -= self.bullet_linesep
+            commands.append(('ET',))
+            commands.append(('end_bullet',))
+            current_y += self.bullet_advance
+            bullet_id += 1
+        return commands
+
+    def render_bullet_page(self, ctx, p, commands):
         pagetr = capypdf.Transition(capypdf.TransitionType.Push, 1.0)
         ctx.set_page_transition(pagetr)
         bullettr = capypdf.Transition(capypdf.TransitionType.Dissolve, 1.0)
-        text_w = self.pdfgen.text_width(p.heading, self.boldbasefont, self.headingsize)
-        head_y = self.h - 1.5*self.headingsize
-        ctx.render_text(p.heading, self.boldbasefont, self.headingsize, (self.w-text_w)/2, head_y)
-        current_y = head_y - 1.5*self.headingsize
-        box_indent = 90
-        bullet_separation = 1.5
-        bullet_linesep = 1.2
-        bullet_id = 1
         ocgs = []
-        for entry in p.entries:
-            ocg = self.pdfgen.add_optional_content_group(capypdf.OptionalContentGroup('bullet' + str(bullet_id)))
-            ocgs.append(ocg)
-            ctx.cmd_BDC(ocg)
-            ctx.render_text('🞂', self.symbolfont, self.symbolsize, box_indent - 40, current_y+1)
-            for line in self.split_to_lines(entry, self.basefont, self.textsize, self.w - 2*box_indent):
-                ctx.render_text(line, self.basefont, self.textsize, box_indent, current_y)
-                current_y -= bullet_linesep*self.textsize
-            ctx.cmd_EMC()
-            current_y += (bullet_linesep - bullet_separation)*self.textsize
-            bullet_id += 1
+        text = None
+        for cmd, *args in commands:
+            if cmd == 'BT':
+                text = ctx.text_new()
+            elif cmd == 'Tf':
+                text.cmd_Tf(getattr(self, args[0]), args[1])
+            elif cmd == 'Td':
+                text.cmd_Td(*args)
+            elif cmd == 'text':
+                text.render_text(args[0])
+            elif cmd == 'ET':
+                ctx.render_text_obj(text)
+                text = None
+            elif cmd == 'glyph':
+                fontname, ptsize, codepoint, x, y = args
+                ctx.render_glyphs([capypdf.Glyph(codepoint, x, y)], getattr(self, fontname), ptsize)
+            elif cmd == 'begin_bullet':
+                ocg = self.pdfgen.add_optional_content_group(capypdf.OptionalContentGroup(args[0]))
+                ocgs.append(ocg)
+                ctx.cmd_BDC(ocg)
+            elif cmd == 'end_bullet':
+                ctx.cmd_EMC()
+            else:
+                raise RuntimeError('Unknown layout command.')
         ctx.add_simple_navigation(ocgs, bullettr)
 
     def render_code_page(self, ctx, p):
@@ -207,13 +258,24 @@ class Demopresentation:
         ctx.render_text_obj(text)
 
     def add_pages(self, pages):
+        # Generators can not be shared between processes, so each worker
+        # loads its own fonts to measure text. Only bullet pages need layout.
+        bullet_pages = [page for page in pages if isinstance(page, BulletPage)]
+        layouts = []
+        if bullet_pages:
+            num_workers = min(len(bullet_pages), os.cpu_count() or 1)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                        initializer=init_layout_worker,
+                                                        initargs=(self.w, self.h)) as executor:
+                layouts = list(executor.map(layout_page, bullet_pages))
+        layouts = iter(layouts)
         for page in pages:
             with self.pdfgen.page_draw_context() as ctx:
                 self.draw_master(ctx)
                 if isinstance(page, TitlePage):
                     self.render_title_page(ctx, page)
                 elif isinstance(page, BulletPage):
-                    self.render_bullet_page(ctx, page)
+                    self.render_bullet_page(ctx, page, next(layouts))
                 elif isinstance(page, CodePage):
                     self.render_code_page(ctx, page)
                 else:
@@ -222,6 +284,15 @@ class Demopresentation:
     def finish(self):
         self.pdfgen.write()
 
+layout_presentation = None
+
+def init_layout_worker(w, h):
+    global layout_presentation
+    layout_presentation = Demopresentation(os.devnull, w, h)
+
+def layout_page(page):
+    return layout_presentation.layout_bullet_page(page)
+
 if __name__ == '__main__':
     p = Demopresentation('demo_presentation.pdf', cm2pt(28), cm2pt(16))
     pages = create_pages()